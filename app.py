@@ -1,7 +1,16 @@
 import os
+import re
 import json
+import math
+import time
 import uuid
+import zlib
+import select
+import socket
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from flask import Flask, request, jsonify, render_template_string, redirect, url_for, session
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -16,11 +25,180 @@ CORS(app)
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 NOTES_FILE = os.path.join(os.path.dirname(__file__), 'data', 'notes.json')
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+
+# Model routing: short note lookups go to the fast model, longer or multi-turn
+# questions go to the strong one. Each model's health is tracked with EWMAs so
+# traffic can shift away from a model that is slow or failing.
+FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-2.0-flash-lite')
+STRONG_MODEL = os.getenv('GEMINI_STRONG_MODEL', 'gemini-2.5-flash')
+ROUTER_SHORT_MESSAGE_CHARS = int(os.getenv('ROUTER_SHORT_MESSAGE_CHARS', '120'))
+ROUTER_EWMA_ALPHA = float(os.getenv('ROUTER_EWMA_ALPHA', '0.2'))
+ROUTER_MAX_ERROR_RATE = float(os.getenv('ROUTER_MAX_ERROR_RATE', '0.5'))
+# Latency is judged against each model's own long-window baseline, since a
+# strong model answering a long multi-turn prompt is normally much slower
+ROUTER_BASELINE_ALPHA = float(os.getenv('ROUTER_BASELINE_ALPHA', '0.02'))
+ROUTER_LATENCY_DEGRADATION = float(os.getenv('ROUTER_LATENCY_DEGRADATION', '2.0'))
+ROUTER_MIN_SAMPLES = int(os.getenv('ROUTER_MIN_SAMPLES', '5'))
+ROUTER_PROBE_INTERVAL = float(os.getenv('ROUTER_PROBE_INTERVAL', '10'))
+
+# Deadlines: each chat request gets a time budget (client-supplied via the
+# X-Request-Timeout header, in seconds, or the default) that shrinks as the
+# request moves through note loading, prompt assembly and the Gemini call
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv('DEFAULT_REQUEST_TIMEOUT', '30'))
+MAX_REQUEST_TIMEOUT = float(os.getenv('MAX_REQUEST_TIMEOUT', '60'))
+MIN_UPSTREAM_TIMEOUT = 0.5
+# Timeouts only count against a model's health when it was given at least this
+# long; a client asking for a 1s budget says nothing about the model
+MODEL_TIMEOUT_FLOOR = float(os.getenv('MODEL_TIMEOUT_FLOOR', '20'))
+DISCONNECT_POLL_INTERVAL = 0.25
+UPSTREAM_WORKERS = int(os.getenv('UPSTREAM_WORKERS', '8'))
+# Calls left running after their client disconnected get their own headroom so
+# they never hold a slot a live request is waiting for
+MAX_ABANDONED_CALLS = int(os.getenv('MAX_ABANDONED_CALLS', '4'))
+# A call that waited longer than this for a thread is not used for model health
+UPSTREAM_QUEUE_TOLERANCE = 0.1
+DEADLINE_EXCEEDED = "Request deadline exceeded"
+CLIENT_DISCONNECTED = "Client disconnected"
+
+# Direct fact lookups ("what's your last name?") are answered from an index of
+# attribute/value pairs extracted from the notes, without calling Gemini
+FACT_CONFIDENCE_THRESHOLD = float(os.getenv('FACT_CONFIDENCE_THRESHOLD', '0.8'))
+
+# Near-duplicate notes are found with MinHash signatures bucketed by LSH bands
+# and collapsed to one copy when the prompt is assembled
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SHINGLE_SIZE = 5
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.8'))
+# A clustered note is only left out of the prompt when the kept note contains at
+# least this share of its shingles; otherwise it is just listed for merging
+NEAR_DUPLICATE_CONTAINMENT = float(os.getenv('NEAR_DUPLICATE_CONTAINMENT', '0.95'))
 
 # Ensure data directory exists
 os.makedirs(os.path.dirname(NOTES_FILE), exist_ok=True)
 
+# Per-model health and routing counters, shared across worker threads
+router_lock = threading.Lock()
+model_stats = {
+    model: {
+        'latency_ewma': None, 'latency_baseline': None, 'error_ewma': 0.0,
+        'requests': 0, 'errors': 0, 'last_used': 0.0
+    }
+    for model in (FAST_MODEL, STRONG_MODEL)
+}
+route_counts = {}
+recent_routes = deque(maxlen=50)
+
+LOOKUP_PATTERN = re.compile(
+    r"^(what|what's|whats|who|when|where|which|how old|how many|do you|are you|is your|did you)\b",
+    re.IGNORECASE
+)
+REASONING_PATTERN = re.compile(
+    r"\b(why|explain|compare|analy[sz]e|plan|write|summari[sz]e|step by step|pros and cons|difference between)\b",
+    re.IGNORECASE
+)
+
+# Gemini calls run here so the request thread can stop waiting on them. Live
+# calls hold one of UPSTREAM_WORKERS slots; an abandoned call gives its slot back
+# and runs on in the extra MAX_ABANDONED_CALLS threads until its deadline.
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS + MAX_ABANDONED_CALLS)
+upstream_slots = threading.BoundedSemaphore(UPSTREAM_WORKERS)
+upstream_lock = threading.Lock()
+abandoned_calls = {'count': 0}
+
+# Fact index built from the notes, refreshed on save or when the notes file changes
+fact_lock = threading.Lock()
+fact_index = {'mtime': None, 'facts': {}}
+
+# MinHash signatures per note and LSH buckets, updated incrementally as notes change
+duplicate_lock = threading.Lock()
+duplicate_index = {'signatures': {}, 'buckets': {}, 'clusters': None}
+
+MERSENNE_PRIME = (1 << 61) - 1
+MINHASH_PARAMS = [
+    (1 + zlib.crc32(f'a{i}'.encode()) * 2654435761 % (MERSENNE_PRIME - 1),
+     zlib.crc32(f'b{i}'.encode()) * 40503 % MERSENNE_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december']
+# Full month names or their standard abbreviations only, so "Marseille" isn't a month
+MONTH_PATTERN = (
+    r"(?:january|february|march|april|may|june|july|august|september|october|november|december"
+    r"|jan|feb|mar|apr|jun|jul|aug|sept?|oct|nov|dec)\b\.?"
+)
+DATE_PART = rf"(?:\d{{1,4}}(?:st|nd|rd|th)?\b|{MONTH_PATTERN})"
+# Places and employers are a run of capitalised words ("New York City", "Bank of
+# America"), so "I live in Istanbul with my family" stops at "Istanbul"
+PROPER_WORD = r"(?!I\b)[A-Z][\w'&-]*"
+PROPER_NOUN = rf"{PROPER_WORD}(?:\s+(?:(?:of|de|del|la|von|van|the)\s+)?{PROPER_WORD})*"
+# Occupations are lowercase, so they end at the first preposition or clause word
+OCCUPATION_STOP = (
+    r"(?:at|in|for|with|as|since|on|from|and|but|or|because|so|now|currently|originally"
+    r"|i|i'm|my|which|who|where|when|while)"
+)
+OCCUPATION = rf"(?:an?\s+)?(?!{OCCUPATION_STOP}\b)[a-z][\w'-]*(?:\s+(?!{OCCUPATION_STOP}\b)[a-z][\w'-]*){{0,3}}"
+
+FACT_PATTERNS = {
+    'surname': re.compile(r"\bmy (?:last ?name|surname|family name) is ([a-z][\w'-]*)", re.IGNORECASE),
+    'name': re.compile(r"\bmy (?:first )?name is ([a-z][\w'-]*)", re.IGNORECASE),
+    'birth_date': re.compile(
+        rf"\b(?:i was|i'm) born (?:on |in )?({DATE_PART}(?:[\s,/-]+{DATE_PART})*)", re.IGNORECASE
+    ),
+    # Case-sensitive value, case-insensitive lead-in
+    'location': re.compile(rf"\b(?i:i (?:live|am based|'m based) in) ({PROPER_NOUN}(?:,\s+{PROPER_NOUN})?)"),
+    'hometown': re.compile(rf"\b(?i:i(?: am|'m| come) from) ({PROPER_NOUN}(?:,\s+{PROPER_NOUN})?)"),
+    'employer': re.compile(rf"\b(?i:i work (?:at|for)) ({PROPER_NOUN})"),
+    'occupation': re.compile(rf"\bmy (?:job|occupation|profession) is ({OCCUPATION})", re.IGNORECASE),
+}
+
+# Question patterns per attribute, with how confident a match is that the
+# question is a plain lookup of that attribute. Only whole-question forms clear
+# the threshold; a passing mention ("what does your last name mean?") doesn't.
+QUESTION_PATTERNS = {
+    'surname': [
+        (re.compile(r"^(?:what(?:'s| is|s)|tell me) your (?:last ?name|surname|family name)$", re.IGNORECASE), 0.95),
+        (re.compile(r"\b(?:last ?name|surname|family name)\b", re.IGNORECASE), 0.5),
+    ],
+    'name': [
+        (re.compile(r"^(?:what(?:'s| is|s)|tell me) your (?:first )?name$", re.IGNORECASE), 0.95),
+        (re.compile(r"^who are you$", re.IGNORECASE), 0.7),
+    ],
+    'birth_date': [
+        (re.compile(r"^when (?:were you|was you) born$", re.IGNORECASE), 0.95),
+        (re.compile(
+            r"^(?:(?:what(?:'s| is|s)|tell me) your (?:birthday|birth date|date of birth)|when is your birthday)$",
+            re.IGNORECASE
+        ), 0.9),
+        (re.compile(r"\b(?:born|birthday|birth date|date of birth)\b", re.IGNORECASE), 0.5),
+    ],
+    'location': [
+        (re.compile(r"^(?:where do you live|where are you based)$", re.IGNORECASE), 0.9),
+    ],
+    'hometown': [
+        (re.compile(r"^where (?:are you from|do you come from)$", re.IGNORECASE), 0.9),
+    ],
+    'employer': [
+        (re.compile(r"^(?:where do you work|who do you work for)$", re.IGNORECASE), 0.9),
+    ],
+    'occupation': [
+        (re.compile(r"^(?:what(?:'s| is|s) your (?:job|occupation|profession)|what do you do for (?:a )?living)$", re.IGNORECASE), 0.9),
+    ],
+}
+
+FACT_ANSWERS = {
+    'name': "My name is {value}.",
+    'surname': "My last name is {value}.",
+    'birth_date': "I was born on {value}.",
+    'birth_year': "I was born in {value}.",
+    'location': "I live in {value}.",
+    'hometown': "I'm from {value}.",
+    'employer': "I work at {value}.",
+    'occupation': "My job is {value}.",
+}
+
 # HTML Templates
 BASE_TEMPLATE = '''
 <!DOCTYPE html>
@@ -206,25 +384,406 @@ def load_notes():
 def save_notes(notes):
     with open(NOTES_FILE, 'w', encoding='utf-8') as f:
         json.dump(notes, f, indent=2, ensure_ascii=False)
+    # No mtime: another worker may have saved since our write, so the next
+    # lookup re-checks the file instead of trusting these facts
+    refresh_fact_index(notes, None)
+    sync_duplicate_index(notes)
+
+def shingles(text):
+    text = ' '.join(re.findall(r"\w+", text.lower()))
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def minhash(text):
+    hashes = [zlib.crc32(shingle.encode()) for shingle in shingles(text)]
+    return tuple(
+        min((a * h + b) % MERSENNE_PRIME for h in hashes)
+        for a, b in MINHASH_PARAMS
+    )
+
+def signature_similarity(sig_a, sig_b):
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+def lsh_keys(signature):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+
+def sync_duplicate_index(notes):
+    """Bring the LSH index in line with the notes, rehashing only new or edited ones"""
+    with duplicate_lock:
+        signatures = duplicate_index['signatures']
+        buckets = duplicate_index['buckets']
+        current = {note['id']: note['content'] for note in notes}
+        changed = False
+        for note_id in list(signatures):
+            content, signature = signatures[note_id]
+            if current.get(note_id) == content:
+                continue
+            for key in lsh_keys(signature):
+                buckets[key].discard(note_id)
+                if not buckets[key]:
+                    del buckets[key]
+            del signatures[note_id]
+            changed = True
+        for note_id, content in current.items():
+            if note_id in signatures:
+                continue
+            signature = minhash(content)
+            signatures[note_id] = (content, signature)
+            for key in lsh_keys(signature):
+                buckets.setdefault(key, set()).add(note_id)
+            changed = True
+        if changed:
+            duplicate_index['clusters'] = None
+
+def get_duplicate_clusters(notes):
+    """Groups of near-duplicate note ids, oldest first. Every pair inside a group
+    is above the threshold (complete linkage), and 'keep' is the newest note,
+    since a later copy is usually a correction of the earlier one."""
+    sync_duplicate_index(notes)
+    position = {note['id']: i for i, note in enumerate(notes)}
+    with duplicate_lock:
+        if duplicate_index['clusters'] is not None:
+            return duplicate_index['clusters']
+        signatures = duplicate_index['signatures']
+
+        neighbours = {}
+        checked = set()
+        for bucket in duplicate_index['buckets'].values():
+            if len(bucket) < 2:
+                continue
+            members = sorted(bucket)
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    if (a, b) in checked:
+                        continue
+                    checked.add((a, b))
+                    if signature_similarity(signatures[a][1], signatures[b][1]) >= NEAR_DUPLICATE_THRESHOLD:
+                        neighbours.setdefault(a, set()).add(b)
+                        neighbours.setdefault(b, set()).add(a)
+
+        def newest_first(ids):
+            return sorted(ids, key=lambda note_id: position.get(note_id, -1), reverse=True)
+
+        assigned = set()
+        clusters = []
+        for keep in newest_first(neighbours):
+            if keep in assigned:
+                continue
+            group = [keep]
+            for other in newest_first(neighbours[keep] - assigned):
+                if all(other in neighbours[member] for member in group[1:]):
+                    group.append(other)
+            if len(group) < 2:
+                continue
+            assigned.update(group)
+            ids = group[::-1]
+            similarity = min(
+                signature_similarity(signatures[a][1], signatures[b][1])
+                for i, a in enumerate(ids) for b in ids[i + 1:]
+            )
+            clusters.append({'ids': ids, 'keep': keep, 'similarity': similarity})
+        duplicate_index['clusters'] = clusters
+        return clusters
+
+def containment(text, other):
+    """Share of text's shingles that also appear in other"""
+    own = shingles(text)
+    return len(own & shingles(other)) / len(own)
+
+def covered_ids(cluster, by_id):
+    """Notes of a cluster whose content the kept note already carries"""
+    keep = by_id.get(cluster['keep'])
+    if keep is None:
+        return []
+    return [
+        note_id for note_id in cluster['ids']
+        if note_id != cluster['keep'] and note_id in by_id
+        and containment(by_id[note_id]['content'], keep['content']) >= NEAR_DUPLICATE_CONTAINMENT
+    ]
+
+def collapse_duplicates(notes):
+    """Drop clustered notes the newest copy already covers, in original order"""
+    by_id = {note['id']: note for note in notes}
+    dropped = set()
+    for cluster in get_duplicate_clusters(notes):
+        dropped.update(covered_ids(cluster, by_id))
+    return [note for note in notes if note['id'] not in dropped]
+
+def build_notes_context(notes, dedupe=True):
+    if dedupe:
+        notes = collapse_duplicates(notes)
+    return "\n\n".join([
+        f"### {note.get('title', 'Note')}:\n{note['content']}"
+        for note in notes
+    ])
+
+def format_date(value):
+    """Normalize '1980 january 24' style dates to 'January 24, 1980' when possible"""
+    year = month = day = None
+    for part in re.split(r"[\s,/-]+", value.lower()):
+        part = part.rstrip('.')
+        digits = re.sub(r"(st|nd|rd|th)$", "", part)
+        if len(digits) == 4 and digits.isdigit():
+            year = digits
+        elif digits.isdigit() and 1 <= int(digits) <= 31:
+            day = str(int(digits))
+        else:
+            month = next((m for m in MONTHS if m.startswith(part[:3])), month)
+    if year and month and day:
+        return f"{month.capitalize()} {day}, {year}"
+    if year and month:
+        return f"{month.capitalize()} {year}"
+    return value
+
+def extract_facts(notes):
+    """Extract attribute/value pairs from the notes; later notes win"""
+    facts = {}
+    for note in notes:
+        for attribute, pattern in FACT_PATTERNS.items():
+            match = pattern.search(note.get('content', ''))
+            if not match:
+                continue
+            value = match.group(1).strip()
+            if attribute == 'birth_date':
+                if not re.search(r"\d", value):
+                    # A bare month isn't a birth date worth answering with
+                    continue
+                value = format_date(value)
+            elif attribute in ('name', 'surname'):
+                # Only the first letter, so "McDonald" keeps its inner capital
+                value = value[:1].upper() + value[1:]
+            facts[attribute] = {'value': value, 'note_id': note.get('id')}
+    return facts
+
+def notes_mtime():
+    try:
+        return os.path.getmtime(NOTES_FILE)
+    except OSError:
+        return None
+
+def refresh_fact_index(notes, mtime):
+    """Rebuild the index. mtime must be read before the notes are loaded, so a
+    save that lands in between makes the next lookup rebuild again"""
+    facts = extract_facts(notes)
+    with fact_lock:
+        fact_index['mtime'] = mtime
+        fact_index['facts'] = facts
+    return facts
+
+def get_fact_index():
+    mtime = notes_mtime()
+    with fact_lock:
+        if mtime is not None and mtime == fact_index['mtime']:
+            return fact_index['facts']
+    # Notes changed on disk (e.g. saved by another worker) since the last build
+    return refresh_fact_index(load_notes(), mtime)
+
+def match_fact(user_message, facts):
+    """Return (attribute, confidence) for the best lookup match, or (None, 0.0)"""
+    question = user_message.strip().rstrip('?!. ').strip()
+    best, best_confidence = None, 0.0
+    for attribute, patterns in QUESTION_PATTERNS.items():
+        if attribute not in facts:
+            continue
+        for pattern, confidence in patterns:
+            if pattern.search(question) and confidence > best_confidence:
+                best, best_confidence = attribute, confidence
+    return best, best_confidence
+
+def answer_from_facts(user_message):
+    facts = get_fact_index()
+    attribute, confidence = match_fact(user_message, facts)
+    if attribute is None or confidence < FACT_CONFIDENCE_THRESHOLD:
+        return None
+    with router_lock:
+        route_counts['local:fact'] = route_counts.get('local:fact', 0) + 1
+        recent_routes.append({'model': 'local', 'reason': f'fact:{attribute}', 'at': time.time()})
+    return fact_answer(attribute, facts[attribute]['value'])
+
+def fact_answer(attribute, value):
+    if attribute == 'birth_date' and re.fullmatch(r"(?:[A-Z][a-z]+ )?\d{4}", value):
+        # "1990" or "January 1990": no day, so "born in"
+        attribute = 'birth_year'
+    return FACT_ANSWERS[attribute].format(value=value)
+
+def latency_is_normal(stats, latency):
+    baseline = stats['latency_baseline']
+    if baseline is None or stats['requests'] - stats['errors'] < ROUTER_MIN_SAMPLES:
+        return True
+    return latency <= ROUTER_LATENCY_DEGRADATION * baseline
+
+def model_is_healthy(model):
+    stats = model_stats[model]
+    if stats['error_ewma'] > ROUTER_MAX_ERROR_RATE:
+        return False
+    return stats['latency_ewma'] is None or latency_is_normal(stats, stats['latency_ewma'])
+
+def record_model_result(model, latency, ok):
+    with router_lock:
+        stats = model_stats[model]
+        was_healthy = model_is_healthy(model)
+        stats['requests'] += 1
+        if not ok:
+            stats['errors'] += 1
+        stats['error_ewma'] += ROUTER_EWMA_ALPHA * ((0.0 if ok else 1.0) - stats['error_ewma'])
+        if not ok:
+            return
+        if stats['latency_ewma'] is None:
+            stats['latency_ewma'] = stats['latency_baseline'] = latency
+            return
+        if not was_healthy and latency_is_normal(stats, latency):
+            # A good probe of a degraded model: recover in a step or two rather
+            # than waiting for the EWMAs to decay one probe at a time
+            stats['latency_ewma'] = latency
+            stats['error_ewma'] /= 2
+        else:
+            stats['latency_ewma'] += ROUTER_EWMA_ALPHA * (latency - stats['latency_ewma'])
+        stats['latency_baseline'] += ROUTER_BASELINE_ALPHA * (latency - stats['latency_baseline'])
 
-def call_gemini(prompt):
+def choose_model(user_message, history):
+    """Pick a model for this chat turn and return (model, reason)"""
+    if history:
+        preferred, reason = STRONG_MODEL, 'multi_turn'
+    elif len(user_message) > ROUTER_SHORT_MESSAGE_CHARS:
+        preferred, reason = STRONG_MODEL, 'long_message'
+    elif REASONING_PATTERN.search(user_message):
+        preferred, reason = STRONG_MODEL, 'reasoning'
+    elif LOOKUP_PATTERN.search(user_message) or user_message.endswith('?'):
+        preferred, reason = FAST_MODEL, 'lookup'
+    else:
+        preferred, reason = STRONG_MODEL, 'default'
+
+    other = FAST_MODEL if preferred == STRONG_MODEL else STRONG_MODEL
+    with router_lock:
+        model = preferred
+        if not model_is_healthy(preferred):
+            if time.time() - model_stats[preferred]['last_used'] >= ROUTER_PROBE_INTERVAL:
+                # Let one request through now and then so a degraded model can recover
+                reason = f'{reason}+probe'
+            elif model_is_healthy(other):
+                model, reason = other, f'{reason}+failover'
+        model_stats[model]['last_used'] = time.time()
+        key = f'{model}:{reason}'
+        route_counts[key] = route_counts.get(key, 0) + 1
+        recent_routes.append({'model': model, 'reason': reason, 'at': time.time()})
+    return model, reason
+
+def request_deadline():
+    """Absolute monotonic deadline for the current request"""
+    try:
+        budget = float(request.headers.get('X-Request-Timeout', DEFAULT_REQUEST_TIMEOUT))
+    except ValueError:
+        budget = DEFAULT_REQUEST_TIMEOUT
+    if not math.isfinite(budget):
+        budget = DEFAULT_REQUEST_TIMEOUT
+    budget = min(max(budget, 0.0), MAX_REQUEST_TIMEOUT)
+    return time.monotonic() + budget
+
+def time_left(deadline):
+    if deadline is None:
+        return DEFAULT_REQUEST_TIMEOUT
+    return deadline - time.monotonic()
+
+def client_socket():
+    """The client connection under gunicorn or the dev server, if exposed"""
+    return request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+
+def client_disconnected(sock):
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A closed connection reads as EOF; anything else is still a live client
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+def finish_upstream_call(call):
+    with upstream_lock:
+        call['done'] = True
+        if call['abandoned']:
+            abandoned_calls['count'] -= 1
+            return
+    upstream_slots.release()
+
+def abandon_upstream_call(call):
+    """Hand the call's slot back if there is room for another abandoned call"""
+    with upstream_lock:
+        if call['done'] or abandoned_calls['count'] >= MAX_ABANDONED_CALLS:
+            return False
+        call['abandoned'] = True
+        abandoned_calls['count'] += 1
+    upstream_slots.release()
+    return True
+
+def post_to_gemini(model, payload, deadline, submitted, call):
+    try:
+        # Time spent waiting for a thread is ours, not the model's
+        track_health = time.monotonic() - submitted <= UPSTREAM_QUEUE_TOLERANCE
+        timeout = time_left(deadline)
+        if timeout < MIN_UPSTREAM_TIMEOUT:
+            return None
+        started = time.monotonic()
+        try:
+            response = requests.post(
+                f"{GEMINI_API_BASE}/{model}:generateContent?key={GEMINI_API_KEY}",
+                headers={"Content-Type": "application/json"},
+                json=payload,
+                timeout=timeout
+            )
+        except requests.Timeout:
+            # A short client budget says nothing about the model
+            if track_health and timeout >= MODEL_TIMEOUT_FLOOR:
+                record_model_result(model, time.monotonic() - started, False)
+            raise
+        except requests.ConnectionError:
+            if track_health:
+                record_model_result(model, time.monotonic() - started, False)
+            raise
+        if track_health:
+            if response.status_code == 200:
+                record_model_result(model, time.monotonic() - started, True)
+            elif response.status_code >= 500 or response.status_code == 429:
+                # Bad or oversized prompts (4xx) are our fault, not a sign the model is degraded
+                record_model_result(model, time.monotonic() - started, False)
+        return response
+    finally:
+        finish_upstream_call(call)
+
+def call_gemini(prompt, model=STRONG_MODEL, deadline=None, sock=None):
     if not GEMINI_API_KEY:
         return None, "Gemini API key not configured"
+    if not upstream_slots.acquire(timeout=max(time_left(deadline) - MIN_UPSTREAM_TIMEOUT, 0)):
+        return None, DEADLINE_EXCEEDED
 
-    headers = {"Content-Type": "application/json"}
     payload = {"contents": [{"parts": [{"text": prompt}]}]}
-
+    call = {'done': False, 'abandoned': False}
+    future = upstream_pool.submit(post_to_gemini, model, payload, deadline, time.monotonic(), call)
     try:
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        while True:
+            try:
+                response = future.result(timeout=DISCONNECT_POLL_INTERVAL)
+                break
+            except FutureTimeoutError:
+                # Nobody will read the answer: free this worker now. The upstream
+                # call is bounded by the deadline and its result dropped.
+                if client_disconnected(sock) and abandon_upstream_call(call):
+                    return None, CLIENT_DISCONNECTED
+        if response is None:
+            return None, DEADLINE_EXCEEDED
         if response.status_code != 200:
             return None, f"API error: {response.status_code} - {response.text}"
         data = response.json()
-        return data['candidates'][0]['content']['parts'][0]['text'], None
+        try:
+            text = data['candidates'][0]['content']['parts'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            # e.g. a safety block, which comes back without content
+            return None, "Gemini returned no text for this message"
+        return text, None
+    except requests.Timeout:
+        return None, DEADLINE_EXCEEDED
     except Exception as e:
         return None, str(e)
 
@@ -283,6 +842,28 @@ def delete_note(note_id):
     save_notes(notes)
     return redirect(url_for('admin_page'))
 
+@app.route('/admin/duplicates')
+def duplicate_notes():
+    if not session.get('authenticated'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    notes = load_notes()
+    by_id = {note['id']: note for note in notes}
+    clusters = [
+        {
+            'notes': [by_id[note_id] for note_id in cluster['ids'] if note_id in by_id],
+            'keep': cluster['keep'],
+            'collapsed': covered_ids(cluster, by_id),
+            'similarity': cluster['similarity']
+        }
+        for cluster in get_duplicate_clusters(notes)
+    ]
+    return jsonify({
+        'threshold': NEAR_DUPLICATE_THRESHOLD,
+        'containment': NEAR_DUPLICATE_CONTAINMENT,
+        'clusters': clusters
+    })
+
 @app.route('/logout')
 def logout():
     session.pop('authenticated', None)
@@ -290,6 +871,7 @@ def logout():
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
+    deadline = request_deadline()
     data = request.get_json()
     user_message = data.get('message', '').strip()
     history = data.get('history', [])
@@ -297,11 +879,14 @@ def chat():
     if not user_message:
         return jsonify({'error': 'Message is required'}), 400
 
+    local_answer = answer_from_facts(user_message)
+    if local_answer:
+        return jsonify({'response': local_answer, 'served_locally': True})
+
     notes = load_notes()
-    notes_context = "\n\n".join([
-        f"### {note.get('title', 'Note')}:\n{note['content']}"
-        for note in notes
-    ])
+    if time_left(deadline) <= 0:
+        return jsonify({'error': DEADLINE_EXCEEDED}), 504
+    notes_context = build_notes_context(notes)
 
     # Build conversation history string
     history_text = ""
@@ -328,14 +913,36 @@ User: {user_message}
 
 Response:"""
 
-    response_text, error = call_gemini(full_prompt)
+    if time_left(deadline) <= 0:
+        return jsonify({'error': DEADLINE_EXCEEDED}), 504
+
+    model, _ = choose_model(user_message, history)
+    response_text, error = call_gemini(full_prompt, model, deadline, client_socket())
+    if error == DEADLINE_EXCEEDED:
+        return jsonify({'error': error}), 504
+    if error == CLIENT_DISCONNECTED:
+        # Status is for the access log only, the client is gone
+        return jsonify({'error': error}), 499
     if error:
         return jsonify({'error': error}), 500
-    return jsonify({'response': response_text})
+    return jsonify({'response': response_text, 'served_locally': False})
 
 @app.route('/api/health')
 def health():
     return jsonify({'status': 'ok', 'gemini_configured': GEMINI_API_KEY is not None})
 
+@app.route('/api/metrics')
+def metrics():
+    with router_lock:
+        models = {
+            model: dict(stats, healthy=model_is_healthy(model))
+            for model, stats in model_stats.items()
+        }
+        return jsonify({
+            'models': models,
+            'routes': dict(route_counts),
+            'recent_routes': list(recent_routes)
+        })
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
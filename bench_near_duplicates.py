@@ -0,0 +1,109 @@
+"""Benchmark near-duplicate collapsing on a synthetic notes corpus.
+
+Builds a corpus of distinct notes, injects lightly edited copies of some of
+them, and compares the prompt context with and without collapsing duplicates.
+
+    python bench_near_duplicates.py [--notes 200] [--duplicate-rate 0.3] [--live]
+
+--live also sends both prompts to Gemini (needs GEMINI_API_KEY) and reports
+the end-to-end latency of each.
+"""
+import argparse
+import random
+import time
+import uuid
+
+import app
+
+TOPICS = ['hiking', 'chess', 'python', 'jazz', 'cooking', 'cycling', 'photography',
+          'gardening', 'astronomy', 'woodworking', 'running', 'painting']
+PLACES = ['Istanbul', 'Berlin', 'Lisbon', 'Toronto', 'Osaka', 'Nairobi', 'Lima', 'Oslo']
+TEMPLATES = [
+    "I have been into {topic} since {year}, mostly on weekends around {place}.",
+    "My favourite thing about {topic} is how it clears my head after a long week in {place}.",
+    "Back in {year} I spent a whole summer in {place} doing nothing but {topic}.",
+    "People often ask me about {topic}; I got started in {place} around {year}.",
+]
+
+
+def make_note(rng, i):
+    content = ' '.join(
+        rng.choice(TEMPLATES).format(
+            topic=rng.choice(TOPICS), place=rng.choice(PLACES), year=rng.randint(1990, 2024)
+        )
+        for _ in range(rng.randint(2, 4))
+    )
+    return {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'title': f'Note {i}', 'content': content}
+
+
+def perturb(rng, note):
+    """A near-identical copy: different case and punctuation, maybe a typo"""
+    content = note['content'].replace('.', '').replace(';', ',')
+    if rng.random() < 0.5:
+        content = content.lower()
+    if rng.random() < 0.5:
+        pos = rng.randrange(len(content))
+        content = content[:pos] + content[pos + 1:]
+    return {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'title': 'Untitled', 'content': content}
+
+
+def build_corpus(size, duplicate_rate, seed):
+    rng = random.Random(seed)
+    unique = int(size / (1 + duplicate_rate))
+    notes = [make_note(rng, i) for i in range(unique)]
+    for _ in range(size - unique):
+        notes.append(perturb(rng, rng.choice(notes[:unique])))
+    rng.shuffle(notes)
+    return notes, unique
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--duplicate-rate', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--live', action='store_true')
+    args = parser.parse_args()
+
+    notes, unique = build_corpus(args.notes, args.duplicate_rate, args.seed)
+
+    _, build_time = timed(lambda: app.sync_duplicate_index(notes), 1)
+    clusters = app.get_duplicate_clusters(notes)
+
+    edited = dict(notes[0], content=notes[0]['content'] + ' One more sentence.')
+    _, update_time = timed(lambda: app.sync_duplicate_index([edited] + notes[1:]), 1)
+    app.sync_duplicate_index(notes)
+
+    full, full_time = timed(lambda: app.build_notes_context(notes, dedupe=False), args.repeat)
+    deduped, deduped_time = timed(lambda: app.build_notes_context(notes), args.repeat)
+
+    print(f"corpus: {len(notes)} notes, {unique} unique, {len(notes) - unique} injected duplicates")
+    clustered = sum(len(c['ids']) - 1 for c in clusters)
+    collapsed = len(notes) - len(app.collapse_duplicates(notes))
+    print(f"clusters found: {len(clusters)} ({collapsed} notes collapsed, "
+          f"{clustered - collapsed} kept in the prompt and only flagged)")
+    print(f"index build: {build_time * 1000:.1f} ms, single-note update: {update_time * 1000:.2f} ms")
+    print(f"prompt context: {len(full)} -> {len(deduped)} chars "
+          f"(~{len(full) // 4} -> ~{len(deduped) // 4} tokens, "
+          f"{100 * (1 - len(deduped) / len(full)):.1f}% smaller)")
+    print(f"context assembly: {full_time * 1000:.2f} ms without dedupe, {deduped_time * 1000:.2f} ms with")
+
+    if args.live:
+        question = "\n\nUser: What do you do on weekends?\n\nResponse:"
+        for label, context in (('full', full), ('deduped', deduped)):
+            started = time.perf_counter()
+            _, error = app.call_gemini(context + question, app.FAST_MODEL)
+            elapsed = time.perf_counter() - started
+            print(f"gemini ({label}): {elapsed:.2f} s" + (f" [error: {error}]" if error else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import pytest
+
+import app
+
+
+def extract(content):
+    facts = app.extract_facts([{'id': 'n1', 'content': content}])
+    return {attribute: fact['value'] for attribute, fact in facts.items()}
+
+
+@pytest.mark.parametrize('content, expected', [
+    ("I live in Istanbul with my family", {'location': 'Istanbul'}),
+    ("I live in New York City.", {'location': 'New York City'}),
+    ("I live in Istanbul, Turkey", {'location': 'Istanbul, Turkey'}),
+    ("I work at Google as an engineer", {'employer': 'Google'}),
+    ("I work at Bank of America since 2010", {'employer': 'Bank of America'}),
+    ("I am from Turkey originally", {'hometown': 'Turkey'}),
+    ("I am from the marketing team", {}),
+    ("I work for the government", {}),
+    ("My job is a teacher at a school", {'occupation': 'a teacher'}),
+])
+def test_place_employer_and_occupation_values_are_bounded(content, expected):
+    assert extract(content) == expected
+
+
+@pytest.mark.parametrize('content', [
+    "I was born in Marseille",
+    "I was born in Mayfield",
+    "I was born in Junction City",
+    "I was born in Decatur",
+    "I was born in May",
+])
+def test_birth_date_needs_a_real_date(content):
+    assert 'birth_date' not in extract(content)
+
+
+def test_names_keep_inner_capitals():
+    assert extract("my last name is McDonald")['surname'] == 'McDonald'
+    assert extract("my name is DeShawn")['name'] == 'DeShawn'
+    assert extract("my lastname is tanriseven")['surname'] == 'Tanriseven'
+
+
+@pytest.mark.parametrize('content, answer', [
+    ("I was born in 1980 january 24", "I was born on January 24, 1980."),
+    ("I was born in 1990", "I was born in 1990."),
+    ("I was born in May 1990", "I was born in May 1990."),
+])
+def test_birth_date_answer_matches_value_shape(content, answer):
+    assert app.fact_answer('birth_date', extract(content)['birth_date']) == answer
+
+
+def test_occupation_answer_keeps_article():
+    value = extract("My job is a teacher at a school")['occupation']
+    assert app.fact_answer('occupation', value) == "My job is a teacher."
+
+
+@pytest.mark.parametrize('question', [
+    "What's your last name?",
+    "what is your surname",
+    "When were you born?",
+    "When is your birthday?",
+])
+def test_lookup_questions_clear_the_threshold(question):
+    facts = extract("my name is Tolga I was born in 1980 january 24. my lastname is tanriseven")
+    _, confidence = app.match_fact(question, facts)
+    assert confidence >= app.FACT_CONFIDENCE_THRESHOLD
+
+
+@pytest.mark.parametrize('question', [
+    "What does your last name mean?",
+    "Do you like your last name?",
+    "Can you spell your surname backwards?",
+    "What did you do on your birthday?",
+])
+def test_passing_mentions_go_to_the_model(question):
+    facts = extract("I was born in 1980 january 24. my lastname is tanriseven")
+    _, confidence = app.match_fact(question, facts)
+    assert confidence < app.FACT_CONFIDENCE_THRESHOLD